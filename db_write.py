@@ -1,67 +1,126 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from faker import Faker
-import random
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sqlite3
 from datetime import datetime, timedelta
 import time
 
 # ============ Database Setup ============
-Base = declarative_base()
+DB_PATH = "db/store.db"
+
+# No secondary indexes here: they are built by create_indexes() after the
+# bulk load, in one sorted pass instead of per inserted row.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER NOT NULL,
+    name VARCHAR,
+    category VARCHAR,
+    price FLOAT,
+    stock INTEGER,
+    PRIMARY KEY (id)
+);
+CREATE TABLE IF NOT EXISTS customers (
+    id INTEGER NOT NULL,
+    name VARCHAR,
+    email VARCHAR,
+    city VARCHAR,
+    PRIMARY KEY (id)
+);
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER NOT NULL,
+    customer_id INTEGER,
+    product_id INTEGER,
+    quantity INTEGER,
+    total FLOAT,
+    PRIMARY KEY (id)
+);
+"""
 
+# ============ Configuration ============
+NUM_PRODUCTS = 10_000  # 10K products
+NUM_CUSTOMERS = 100_000  # 100K customers
+NUM_ORDERS = 1_000_000  # 1M orders
 
-class Product(Base):
-    __tablename__ = "products"
-    id = Column(Integer, primary_key=True)
-    name = Column(String)
-    category = Column(String)
-    price = Column(Float)
-    stock = Column(Integer)
+BATCH_SIZE = 10_000  # Insert in batches of 10K
+SEED = 42  # Base seed so generated data is reproducible
+# Each table draws from its own child of SEED, so their streams don't correlate
+PRODUCT_STREAM, CUSTOMER_STREAM, ORDER_STREAM = range(3)
+# Faker values are drawn once into pools and sampled with replacement
+BRAND_POOL_SIZE = 512
+COLOR_POOL_SIZE = 256
+CITY_POOL_SIZE = 1024
 
+# Fixed so chunk boundaries and seeds don't depend on the machine's core count
+NUM_CHUNKS = 32
 
-class Customer(Base):
-    __tablename__ = "customers"
-    id = Column(Integer, primary_key=True)
-    name = Column(String)
-    email = Column(String)
-    city = Column(String)
+PROGRESS_INTERVAL = 0.1  # Redraw progress lines at most ~10 times a second
 
+PRODUCT_COLUMNS = ("name", "category", "price", "stock")
+CUSTOMER_COLUMNS = ("name", "email", "city")
+ORDER_COLUMNS = ("customer_id", "product_id", "quantity", "total")
 
-class Order(Base):
-    __tablename__ = "orders"
-    id = Column(Integer, primary_key=True)
-    customer_id = Column(Integer)
-    product_id = Column(Integer)
-    quantity = Column(Integer)
-    total = Column(Float)
+INDEXES = {
+    "idx_orders_customer": "orders(customer_id)",
+    "idx_orders_product": "orders(product_id)",
+}
 
 
-# ============ Configuration ============
-NUM_PRODUCTS = 10_000  # 10K products
-NUM_CUSTOMERS = 100_000  # 100K customers
-NUM_ORDERS = 1_000_000  # 1M orders
+def seed_sequence(stream):
+    """Child SeedSequence for one table, same as SeedSequence(SEED).spawn(3)[stream]"""
+    return np.random.SeedSequence(SEED, spawn_key=(stream,))
 
-BATCH_SIZE = 10_000  # Insert in batches of 10K
 
 # ============ Initialize ============
 fake = Faker()
-engine = create_engine("sqlite:///db/store.db", echo=False)
-Base.metadata.create_all(engine)
+fake.seed_instance(SEED)  # Pools of brands/colors/cities are reproducible too
 
-Session = sessionmaker(bind=engine)
-session = Session()
 
+def connect_database(path=DB_PATH):
+    """Open the writer connection, tuned for bulk ingest"""
+    # Autocommit mode: transactions are issued explicitly with BEGIN/COMMIT
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA synchronous=OFF")  # Data is regenerable, skip fsync
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MiB page cache
+    conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+    conn.executescript(SCHEMA)
+    return conn
 
-def clear_database():
+
+def clear_database(conn):
     """Clear all existing data"""
     print("🗑️  Clearing existing data...")
-    session.execute(text("DELETE FROM orders"))
-    session.execute(text("DELETE FROM products"))
-    session.execute(text("DELETE FROM customers"))
-    session.commit()
+    # No journal during the load phase, restore_journal() switches back to WAL
+    conn.execute("PRAGMA journal_mode=OFF")
+    # Skip per-row constraint checks while loading
+    conn.execute("PRAGMA foreign_keys=OFF")
+    conn.execute("PRAGMA ignore_check_constraints=ON")
+    # Drop indexes left by a previous run so inserts don't maintain them
+    for name in INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+    conn.execute("DELETE FROM orders")
+    conn.execute("DELETE FROM products")
+    conn.execute("DELETE FROM customers")
     print("✅ Database cleared!\n")
 
 
+def create_indexes(conn):
+    """Build secondary indexes once the tables are loaded"""
+    print("\n🗂️  Creating indexes...")
+    start_time = time.time()
+    for name, target in INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+    print(f"  ✅ Created {len(INDEXES)} indexes in {time.time() - start_time:.2f}s")
+
+
+def restore_journal(conn):
+    """Switch back to WAL so readers (main.py) don't block on the writer"""
+    conn.execute("PRAGMA ignore_check_constraints=OFF")
+    conn.execute("PRAGMA locking_mode=NORMAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+
+
 def generate_products(num_products):
     """Generate realistic product data"""
     print(f"📦 Generating {num_products:,} products...")
@@ -150,31 +209,40 @@ def generate_products(num_products):
         ],
     }
 
-    products = []
     start_time = time.time()
-
-    for i in range(num_products):
-        category = random.choice(categories)
-        prefix = random.choice(product_prefixes[category])
-        brand = fake.company().split()[0]
-
-        product = {
-            "name": f"{brand} {prefix} {fake.color_name()}",
-            "category": category,
-            "price": round(random.uniform(9.99, 2999.99), 2),
-            "stock": random.randint(0, 1000),
-        }
-        products.append(product)
-
-        # Progress indicator
-        if (i + 1) % 1000 == 0:
-            elapsed = time.time() - start_time
-            rate = (i + 1) / elapsed
-            eta = (num_products - i - 1) / rate
-            print(
-                f"  Progress: {i+1:,}/{num_products:,} ({(i+1)/num_products*100:.1f}%) - ETA: {eta:.1f}s",
-                end="\r",
-            )
+    rng = np.random.default_rng(seed_sequence(PRODUCT_STREAM))
+
+    # Prefix lists in category order, so a category index also picks its prefixes
+    prefix_lists = [product_prefixes[category] for category in categories]
+    prefix_counts = np.array([len(prefixes) for prefixes in prefix_lists])
+
+    category_idx = rng.integers(0, len(categories), num_products)
+    prefix_idx = (rng.random(num_products) * prefix_counts[category_idx]).astype(int)
+    prices = np.round(rng.uniform(9.99, 2999.99, num_products), 2)
+    stocks = rng.integers(0, 1001, num_products)
+
+    # Sample brands and colors from small pools instead of calling Faker per row
+    brand_pool = [fake.company().split()[0] for _ in range(BRAND_POOL_SIZE)]
+    color_pool = [fake.color_name() for _ in range(COLOR_POOL_SIZE)]
+    brands = np.array(brand_pool, dtype=object)[
+        rng.integers(0, BRAND_POOL_SIZE, num_products)
+    ].tolist()
+    colors = np.array(color_pool, dtype=object)[
+        rng.integers(0, COLOR_POOL_SIZE, num_products)
+    ].tolist()
+
+    # Positional rows in PRODUCT_COLUMNS order
+    products = [
+        (f"{brand} {prefix_lists[c][p]} {color}", categories[c], price, stock)
+        for brand, color, c, p, price, stock in zip(
+            brands,
+            colors,
+            category_idx.tolist(),
+            prefix_idx.tolist(),
+            prices.tolist(),
+            stocks.tolist(),
+        )
+    ]
 
     print(
         f"\n  Generated {len(products):,} products in {time.time() - start_time:.2f}s"
@@ -182,26 +250,67 @@ def generate_products(num_products):
     return products
 
 
+def run_in_chunks(worker, total, seed_seq, *args):
+    """Split range(total) into NUM_CHUNKS chunks, run them in a process pool and concatenate"""
+    num_workers = min(os.cpu_count() or 1, NUM_CHUNKS)
+    chunk_size = max(1, -(-total // NUM_CHUNKS))
+    bounds = [
+        (start, min(start + chunk_size, total)) for start in range(0, total, chunk_size)
+    ]
+
+    # Independent child seeds, the same on every machine
+    seeds = [int(child.generate_state(1)[0]) for child in seed_seq.spawn(len(bounds))]
+
+    rows = []
+    start_time = last_print = time.time()
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        # Each chunk gets its own seed so workers never share RNG state
+        futures = [
+            pool.submit(worker, start, end, seed, *args)
+            for (start, end), seed in zip(bounds, seeds)
+        ]
+        for future in futures:
+            rows.extend(future.result())
+
+            # Progress indicator, throttled to PROGRESS_INTERVAL
+            now = time.time()
+            if now - last_print < PROGRESS_INTERVAL and len(rows) < total:
+                continue
+            last_print = now
+            elapsed = now - start_time
+            rate = len(rows) / elapsed if elapsed > 0 else 0
+            eta = (total - len(rows)) / rate if rate > 0 else 0
+            print(
+                f"  Progress: {len(rows):,}/{total:,} ({len(rows)/total*100:.1f}%) - ETA: {eta:.1f}s",
+                end="\r",
+            )
+
+    return rows
+
+
+def _gen_customer_chunk(n_start, n_end, seed, city_pool):
+    """Generate customers n_start..n_end with a worker-local Faker"""
+    chunk_fake = Faker()
+    chunk_fake.seed_instance(seed)
+    cities = chunk_fake.random.choices(city_pool, k=n_end - n_start)
+
+    # Bind the providers once, Faker resolves them through its proxy otherwise
+    fake_name = chunk_fake.name
+    fake_email = chunk_fake.email
+    # Positional rows in CUSTOMER_COLUMNS order
+    return [(fake_name(), fake_email(), city) for city in cities]
+
+
 def generate_customers(num_customers):
     """Generate realistic customer data"""
     print(f"\n👥 Generating {num_customers:,} customers...")
 
-    customers = []
     start_time = time.time()
-
-    for i in range(num_customers):
-        customer = {"name": fake.name(), "email": fake.email(), "city": fake.city()}
-        customers.append(customer)
-
-        # Progress indicator
-        if (i + 1) % 1000 == 0:
-            elapsed = time.time() - start_time
-            rate = (i + 1) / elapsed
-            eta = (num_customers - i - 1) / rate
-            print(
-                f"  Progress: {i+1:,}/{num_customers:,} ({(i+1)/num_customers*100:.1f}%) - ETA: {eta:.1f}s",
-                end="\r",
-            )
+    city_pool = [fake.city() for _ in range(CITY_POOL_SIZE)]
+    customers = run_in_chunks(
+        _gen_customer_chunk, num_customers, seed_sequence(CUSTOMER_STREAM), city_pool
+    )
 
     print(
         f"\n  Generated {len(customers):,} customers in {time.time() - start_time:.2f}s"
@@ -209,59 +318,74 @@ def generate_customers(num_customers):
     return customers
 
 
-def generate_orders(num_orders, num_customers, num_products):
-    """Generate realistic order data"""
-    print(f"\n📋 Generating {num_orders:,} orders...")
+def stream_orders(num_orders, num_customers, num_products, batch_size=10000):
+    """Return a generator of realistic order batches, announced right away"""
+    # Printed here, a generator body would only run once the first batch is pulled
+    print(f"\n📋 Streaming {num_orders:,} orders in batches of {batch_size:,}...")
+
+    rng = np.random.default_rng(seed_sequence(ORDER_STREAM))
+    return _order_batches(rng, num_orders, num_customers, num_products, batch_size)
 
-    orders = []
-    start_time = time.time()
 
-    for i in range(num_orders):
-        customer_id = random.randint(1, num_customers)
-        product_id = random.randint(1, num_products)
-        quantity = random.randint(1, 10)
+def _order_batches(rng, num_orders, num_customers, num_products, batch_size):
+    """Yield realistic order data one batch at a time"""
+    for start in range(0, num_orders, batch_size):
+        n = min(batch_size, num_orders - start)
+
+        # One vectorized draw per column instead of four Python calls per row
+        customer_ids = rng.integers(1, num_customers + 1, n)
+        product_ids = rng.integers(1, num_products + 1, n)
+        quantities = rng.integers(1, 11, n)
 
         # Price will be calculated based on product, but we'll use random for dummy data
-        unit_price = round(random.uniform(9.99, 2999.99), 2)
-        total = round(unit_price * quantity, 2)
-
-        order = {
-            "customer_id": customer_id,
-            "product_id": product_id,
-            "quantity": quantity,
-            "total": total,
-        }
-        orders.append(order)
-
-        # Progress indicator
-        if (i + 1) % 10000 == 0:
-            elapsed = time.time() - start_time
-            rate = (i + 1) / elapsed
-            eta = (num_orders - i - 1) / rate
-            print(
-                f"  Progress: {i+1:,}/{num_orders:,} ({(i+1)/num_orders*100:.1f}%) - ETA: {eta:.1f}s",
-                end="\r",
+        unit_prices = np.round(rng.uniform(9.99, 2999.99, n), 2)
+        totals = np.round(unit_prices * quantities, 2)
+
+        # Positional rows in ORDER_COLUMNS order, no per-row dicts
+        yield list(
+            zip(
+                customer_ids.tolist(),
+                product_ids.tolist(),
+                quantities.tolist(),
+                totals.tolist(),
             )
+        )
 
-    print(f"\n  Generated {len(orders):,} orders in {time.time() - start_time:.2f}s")
-    return orders
 
+def bulk_insert(conn, table, columns, data, batch_size=10000, total=None):
+    """Insert data in batches with executemany, inside the caller's transaction
 
-def bulk_insert(table_class, data, batch_size=10000):
-    """Insert data in batches for better performance"""
-    total = len(data)
-    print(f"\n💾 Inserting {total:,} records into {table_class.__tablename__}...")
+    Rows are positional tuples in columns order.
+    data is either a list (sliced into batch_size chunks) or an iterable of
+    ready-made batches, in which case total is needed for progress output.
+    """
+    if isinstance(data, list):
+        total = len(data)
+        batches = (data[i : i + batch_size] for i in range(0, total, batch_size))
+    elif total is None:
+        raise ValueError("bulk_insert needs total when data is not a list")
+    else:
+        batches = data
 
-    start_time = time.time()
+    print(f"\n💾 Inserting {total:,} records into {table}...")
+
+    placeholders = ", ".join("?" * len(columns))
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+
+    start_time = last_print = time.time()
     inserted = 0
 
-    for i in range(0, total, batch_size):
-        batch = data[i : i + batch_size]
-        session.bulk_insert_mappings(table_class, batch)
-        session.commit()
+    for batch in batches:
+        conn.executemany(sql, batch)
 
         inserted += len(batch)
-        elapsed = time.time() - start_time
+
+        # Progress indicator, throttled to PROGRESS_INTERVAL
+        now = time.time()
+        if now - last_print < PROGRESS_INTERVAL and inserted < total:
+            continue
+        last_print = now
+        elapsed = now - start_time
         rate = inserted / elapsed if elapsed > 0 else 0
         eta = (total - inserted) / rate if rate > 0 else 0
 
@@ -289,18 +413,28 @@ def main():
     print(f"Total:     {NUM_PRODUCTS + NUM_CUSTOMERS + NUM_ORDERS:,} records")
     print("=" * 60)
 
+    # One connection for the whole load so the per-connection PRAGMAs stick
+    conn = connect_database()
+
     # Step 1: Clear existing data
-    clear_database()
+    clear_database(conn)
 
     # Step 2: Generate data
     products_data = generate_products(NUM_PRODUCTS)
     customers_data = generate_customers(NUM_CUSTOMERS)
-    orders_data = generate_orders(NUM_ORDERS, NUM_CUSTOMERS, NUM_PRODUCTS)
-
-    # Step 3: Insert data
-    bulk_insert(Product, products_data, BATCH_SIZE)
-    bulk_insert(Customer, customers_data, BATCH_SIZE)
-    bulk_insert(Order, orders_data, BATCH_SIZE)
+    # Orders are generated lazily while inserting, one batch in memory at a time
+    orders_batches = stream_orders(NUM_ORDERS, NUM_CUSTOMERS, NUM_PRODUCTS, BATCH_SIZE)
+
+    # Step 3: Insert data (one transaction for all three tables)
+    conn.execute("BEGIN")
+    bulk_insert(conn, "products", PRODUCT_COLUMNS, products_data, BATCH_SIZE)
+    bulk_insert(conn, "customers", CUSTOMER_COLUMNS, customers_data, BATCH_SIZE)
+    bulk_insert(
+        conn, "orders", ORDER_COLUMNS, orders_batches, BATCH_SIZE, total=NUM_ORDERS
+    )
+    conn.execute("COMMIT")
+    create_indexes(conn)
+    restore_journal(conn)
 
     # Final summary
     total_time = time.time() - total_start
@@ -316,16 +450,18 @@ def main():
 
     # Verify counts
     print("\n📊 Verification:")
-    product_count = session.query(Product).count()
-    customer_count = session.query(Customer).count()
-    order_count = session.query(Order).count()
+    product_count, customer_count, order_count = conn.execute(
+        "SELECT (SELECT COUNT(*) FROM products), "
+        "(SELECT COUNT(*) FROM customers), "
+        "(SELECT COUNT(*) FROM orders)"
+    ).fetchone()
 
     print(f"  Products:  {product_count:,}")
     print(f"  Customers: {customer_count:,}")
     print(f"  Orders:    {order_count:,}")
     print(f"  Total:     {product_count + customer_count + order_count:,}")
 
-    session.close()
+    conn.close()
     print("\n✅ Done!")
 
 
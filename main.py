@@ -1,32 +1,185 @@
 import os
+import re
+import atexit
+import sys
 import json
+import functools
+import hashlib
+import itertools
+import sqlite3
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_community.utilities import SQLDatabase
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from pydantic import BaseModel, Field
+from collections import deque
 from datetime import datetime
 from pathlib import Path
 import time
-import signal
+import numpy as np
+import sqlglot
+from sqlglot import exp
+
+try:
+    import orjson
+except ImportError:  # Optional, stdlib json is used without it
+    orjson = None
 
 load_dotenv()
 
 
+# History lines are read and written as bytes
+if orjson is not None:
+
+    def _dumps_line(entry: dict) -> bytes:
+        return orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE)
+
+    _loads = orjson.loads
+else:
+
+    def _dumps_line(entry: dict) -> bytes:
+        return (json.dumps(entry, separators=(",", ":")) + "\n").encode()
+
+    _loads = json.loads
+
+
 class TimeoutException(Exception):
     pass
 
 
-def timeout_handler(signum, frame):
-    raise TimeoutException("Query execution timeout")
+DB_PATH = "db/store.db"
+SCHEMA_CACHE_FILE = ".schema_cache.json"
+EMBEDDING_MODEL = "openai/text-embedding-3-small"
+MAX_CACHE_ENTRIES = 1000
+CACHE_SAVE_EVERY = 20  # New cache entries kept in memory before the file is rewritten
+CONTEXT_TURNS = 5  # History turns sent with each question
+CONTEXT_ANSWER_CHARS = 400  # Past answers are cut to this in the context
+IOV_MAX = 1024  # Most buffers one os.writev call accepts on Linux and macOS
+
+# Full-text index over every turn, kept in sync with history by triggers
+HISTORY_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    ts TEXT,
+    question TEXT,
+    sql TEXT,
+    answer TEXT,
+    status TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+    question, sql, answer,
+    content=history, content_rowid=id,
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS history_ai AFTER INSERT ON history BEGIN
+    INSERT INTO history_fts(rowid, question, sql, answer)
+    VALUES (new.id, new.question, new.sql, new.answer);
+END;
+CREATE TRIGGER IF NOT EXISTS history_ad AFTER DELETE ON history BEGIN
+    INSERT INTO history_fts(history_fts, rowid, question, sql, answer)
+    VALUES ('delete', old.id, old.question, old.sql, old.answer);
+END;
+CREATE TRIGGER IF NOT EXISTS history_au AFTER UPDATE ON history BEGIN
+    INSERT INTO history_fts(history_fts, rowid, question, sql, answer)
+    VALUES ('delete', old.id, old.question, old.sql, old.answer);
+    INSERT INTO history_fts(rowid, question, sql, answer)
+    VALUES (new.id, new.question, new.sql, new.answer);
+END;
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def _get_schema(db: SQLDatabase) -> str:
+    """Reflect the schema once per database, reusing the disk copy while the file is unchanged"""
+    st = os.stat(DB_PATH)
+    key = f"{st.st_mtime_ns}-{st.st_size}"
+    try:
+        with open(SCHEMA_CACHE_FILE, "r") as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            return cached["schema"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # Missing, corrupt or stale cache, reflect again
+
+    schema = db.get_table_info()
+    try:
+        with open(SCHEMA_CACHE_FILE, "w") as f:
+            json.dump({"key": key, "schema": schema}, f)
+    except OSError:
+        pass  # Read-only directory, just skip the cache
+    return schema
+
+
+class SqlAnswer(BaseModel):
+    """Structured reply of the SQL generation call"""
+
+    sql: str = Field(description="The SQL query to run")
+    answer_format: str = Field(
+        description="A short friendly answer to the question, with {result} "
+        "where the query's single result value goes"
+    )
 
 
 class SQLChatWithPersistence:
+    # Patterns used by clean_sql() on every LLM response
+    _FENCE_RE = re.compile(r"```(?:sql)?\s*(.*?)```", re.S | re.I)
+    # Quoted strings are matched too, so a -- inside a literal is kept
+    _COMMENT_RE = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*""")
+    _NEWLINES_RE = re.compile(r"\s*\n\s*")
+    # First SQL keyword; WITH only when it starts a CTE, not in plain English
+    _KEYWORD_RE = re.compile(
+        r"\b(?:SELECT|INSERT|UPDATE|DELETE"
+        r"|WITH(?=\s+(?:RECURSIVE\s+)?\w+\s*(?:\([^)]*\)\s*)?AS\b))\b",
+        re.I,
+    )
+
+    # A result holding exactly one value, e.g. [(42,)] or [('Paris',)]
+    _SCALAR_RE = re.compile(r"\[\(([^,()]*),\)\]")
+
+    # Questions leaning on the previous turn, e.g. "and in Paris?" or "show them"
+    _FOLLOWUP_RE = re.compile(
+        r"^\s*(?:and|or|but|also|then|now|same|what about|how about|in|for|by|as)\b"
+        r"|\b(?:it|its|they|them|their|those|these|that|above|previous|instead)\b",
+        re.I,
+    )
+
+    # Row dumps like [(1, 'a'), (2, 'b'), ...] echoed into answers, long ones only
+    _RESULT_RE = re.compile(r"\[\(.{80,}?(?:\)\]| \.\.\.\(truncated\))", re.S)
+
+    # Never changes, so provider prompt caching can reuse the prefix every turn
+    _STATIC_SYSTEM = """You are a helpful SQL database assistant.
+
+⚠️ CRITICAL RULES (MUST FOLLOW):
+1. ALWAYS add a LIMIT (the row limit given below) to SELECT queries (unless using COUNT/SUM/AVG)
+2. Prefer aggregations (COUNT, SUM, AVG) over SELECT *
+3. Always use WHERE clauses to filter data when possible
+4. Use indexed columns for filtering: customer_id, product_id, id
+5. Write ONLY the SQL query, no explanations or markdown
+6. For large results, use TOP N or LIMIT queries
+"""
+
+    # Statements that modify data or schema, rejected anywhere in a query
+    _WRITE_NODES = (
+        exp.Insert,
+        exp.Update,
+        exp.Delete,
+        exp.Drop,
+        exp.Alter,
+        exp.Create,
+        exp.TruncateTable,
+        exp.Command,
+    )
+
     def __init__(
         self,
         max_history: int = 20,
-        history_file: str = "chat_history.json",
+        history_file: str = "chat_history.jsonl",
         max_rows: int = 100,
+        max_result_chars: int = 2000,
         query_timeout: int = 10,
+        embed_cache_file: str = "embed_cache.npz",
+        similarity_threshold: float = 0.92,
+        history_db: str = "history.db",
     ):
         self.llm = ChatOpenAI(
             openai_api_key=os.getenv("OPENROUTER_API_KEY"),
@@ -35,170 +188,461 @@ class SQLChatWithPersistence:
             temperature=0,
             max_tokens=1024,
         )
-        self.db = SQLDatabase.from_uri("sqlite:///db/store.db")
+        # SQLAlchemy is only used for schema reflection, queries go through _raw
+        # Lazy, so a warm schema cache skips reflecting every table at startup
+        self.db = SQLDatabase.from_uri(
+            f"sqlite:///{DB_PATH}", lazy_table_reflection=True
+        )
+        self._raw = self._connect_raw()
+        self._query_deadline = None  # time.monotonic() deadline of the running query
         self.max_history = max_history
         self.history_file = history_file
         self.max_rows = max_rows  # Maximum rows to return
+        self.max_result_chars = max_result_chars  # Cap on the formatted result
         self.query_timeout = query_timeout  # Query timeout in seconds
-        self.chat_history = self.load_history()
-
-        # Enhanced system prompt with production guidelines
-        self.system_prompt = f"""You are a helpful SQL database assistant.
-
-⚠️ CRITICAL RULES (MUST FOLLOW):
-1. ALWAYS add LIMIT {self.max_rows} to SELECT queries (unless using COUNT/SUM/AVG)
-2. Prefer aggregations (COUNT, SUM, AVG) over SELECT *
-3. Always use WHERE clauses to filter data when possible
-4. Use indexed columns for filtering: customer_id, product_id, id
-5. Write ONLY the SQL query, no explanations or markdown
-6. For large results, use TOP N or LIMIT queries
-
-Database Schema:
+        # Checked before open() creates the file, an empty file may just be cleared
+        first_run = not Path(self.history_file).exists()
+        # Kept open for the whole session, each turn appends one line
+        self._history_fp = open(self.history_file, "ab", buffering=0)
+        # Bounded: appending past max_history drops the oldest entry
+        self.chat_history = deque(self.load_history(first_run), maxlen=max_history)
+        # Question embeddings aligned with chat_history, None until needed
+        self._history_vecs = deque([None] * len(self.chat_history), maxlen=max_history)
+        self.history_db = history_db
+        self._history_index = self._open_history_index()
+        atexit.register(self.close)
+
+        # Stable for the whole session, sent right after the static system prompt
+        self.schema_prompt = f"""Database Schema:
 {self.get_schema()}
 
 Available Tables: {self.db.get_usable_table_names()}
+Row limit for SELECT queries: {self.max_rows}
 """
 
+        # Semantic cache of past answers, only sound when the LLM is deterministic
+        self._emb = OpenAIEmbeddings(
+            openai_api_key=os.getenv("OPENROUTER_API_KEY"),
+            openai_api_base="https://openrouter.ai/api/v1",
+            model=EMBEDDING_MODEL,
+            check_embedding_ctx_length=False,  # Send text, not tiktoken ids
+        )
+        self.embed_cache_file = embed_cache_file
+        self.similarity_threshold = similarity_threshold
+        self._use_cache = self.llm.temperature == 0
+        # Cached answers are only valid for the same schema and embedding model;
+        # bump the version when the entry layout changes
+        self._cache_key = hashlib.sha256(
+            f"v2\n{EMBEDDING_MODEL}\n{self.schema_prompt}".encode()
+        ).hexdigest()
+        self._cache_vecs, self._cache_entries = self._load_embed_cache()
+        self._cache_unsaved = 0
+
+    def close(self):
+        """Close the history file and database connections, safe to call twice"""
+        if self._cache_unsaved:
+            self._save_embed_cache()
+        self._history_fp.close()
+        self._history_index.close()
+        self._raw.close()
+
     def get_schema(self):
-        return self.db.get_table_info()
+        return _get_schema(self.db)
+
+    def load_history(self, first_run: bool = False) -> list:
+        """Load the last max_history entries from the JSONL history file"""
+        legacy_file = Path(self.history_file).with_suffix(".json")
+        if first_run and legacy_file.exists():
+            self.migrate_json_to_jsonl(legacy_file)
+
+        # Only the tail is needed; one line past the rotation threshold is
+        # enough to know the file must be rotated on the next save
+        entries = []
+        for line in self._tail_lines(self.history_file, self.max_history * 2 + 1):
+            try:
+                entries.append(_loads(line))
+            except ValueError:
+                continue  # Skip blank or partially written lines
+        self._history_lines = len(entries)
+        return entries[-self.max_history :]
+
+    def migrate_json_to_jsonl(self, legacy_file) -> int:
+        """Append the entries of an old chat_history.json, returns how many"""
+        try:
+            with open(legacy_file, "rb") as f:
+                entries = _loads(f.read())
+        except (OSError, ValueError):
+            return 0
+        self._bulk_append(entries)
+        return len(entries)
+
+    def _bulk_append(self, entries: list):
+        """Append many entries to the history file with as few syscalls as possible"""
+        bufs = [_dumps_line(entry) for entry in entries]
+        fd = self._history_fp.fileno()
+
+        for start in range(0, len(bufs), IOV_MAX):
+            chunk = bufs[start : start + IOV_MAX]
+            if hasattr(os, "writev"):
+                written = os.writev(fd, chunk)
+            else:  # Windows has no writev, the loop below writes it all
+                written = 0
+            # Finish a short write plainly, joining only what is left
+            if written < sum(map(len, chunk)):
+                rest = b"".join(chunk)[written:]
+                while rest:
+                    rest = rest[os.write(fd, rest) :]
+
+    def _open_history_index(self) -> sqlite3.Connection:
+        """Open the search index, seeding it from the loaded history on first use"""
+        conn = sqlite3.connect(self.history_db, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(HISTORY_INDEX_SCHEMA)
+        if conn.execute("SELECT 1 FROM history LIMIT 1").fetchone() is None:
+            conn.executemany(
+                "INSERT INTO history (ts, question, sql, answer, status) VALUES (?, ?, ?, ?, ?)",
+                [self._index_row(entry) for entry in self.chat_history],
+            )
+        return conn
+
+    @staticmethod
+    def _index_row(entry: dict) -> tuple:
+        """Column values for one history entry in the search index"""
+        return (
+            entry.get("timestamp"),
+            entry.get("question", ""),
+            entry.get("sql", ""),
+            entry.get("answer", ""),
+            entry.get("status"),
+        )
+
+    @staticmethod
+    def _tail_lines(path: str, n: int, block_size: int = 64 * 1024) -> list:
+        """Return the last n lines of a file as bytes, reading blocks from the end"""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            pos = os.lseek(fd, 0, os.SEEK_END)
+            blocks = []
+            newlines = 0
+            # n + 1 newlines bound n complete lines (the file ends with one)
+            while pos > 0 and newlines <= n:
+                size = min(block_size, pos)
+                pos -= size
+                os.lseek(fd, pos, os.SEEK_SET)
+                block = os.read(fd, size)
+                blocks.append(block)
+                newlines += block.count(b"\n")
+        finally:
+            os.close(fd)
+
+        lines = b"".join(reversed(blocks)).split(b"\n")
+        if pos > 0:
+            lines = lines[1:]  # First line may be cut mid-way
+        return [line for line in lines if line.strip()][-n:]
+
+    def save_history(self, entry: dict):
+        """Append one entry to the history file and the search index"""
+        self._history_fp.write(_dumps_line(entry))
+        self._history_index.execute(
+            "INSERT INTO history (ts, question, sql, answer, status) VALUES (?, ?, ?, ?, ?)",
+            self._index_row(entry),
+        )
+        self._history_lines += 1
+
+        # Rotate so the file doesn't grow without bound
+        if self._history_lines > self.max_history * 2:
+            self._rewrite_history()
+
+    def _rewrite_history(self):
+        """Rewrite the history file with only the in-memory entries"""
+        self._history_fp.close()
+        with open(self.history_file, "wb") as f:
+            f.writelines(_dumps_line(entry) for entry in self.chat_history)
+        self._history_lines = len(self.chat_history)
+        self._history_fp = open(self.history_file, "ab", buffering=0)
+
+    def _load_embed_cache(self) -> tuple:
+        """Load cached question embeddings, empty if missing or built for another schema"""
+        try:
+            with np.load(self.embed_cache_file) as data:
+                if str(data["key"]) == self._cache_key:
+                    entries = [json.loads(e) for e in data["entries"]]
+                    return data["vecs"], entries
+        except (OSError, KeyError, ValueError):
+            pass
+        return np.empty((0, 0), dtype=np.float32), []
+
+    def _save_embed_cache(self):
+        """Write the embedding cache, vectors and entries stay index-aligned"""
+        np.savez(
+            self.embed_cache_file,
+            key=self._cache_key,
+            vecs=self._cache_vecs,
+            entries=np.array([json.dumps(e) for e in self._cache_entries]),
+        )
+        self._cache_unsaved = 0
+
+    def _embed(self, question: str) -> np.ndarray:
+        """Unit-length embedding, so a dot product is the cosine similarity"""
+        vec = np.asarray(self._emb.embed_query(question), dtype=np.float32)
+        return vec / np.linalg.norm(vec)
+
+    def _context_hash(self) -> str:
+        """Identify the turn a question follows, so follow-ups only match in the same spot"""
+        if not self.chat_history:
+            return ""
+        last = self.chat_history[-1]
+        return hashlib.sha256(
+            f"{last['question']}\n{last['sql']}".encode()
+        ).hexdigest()[:16]
+
+    def _cache_lookup(self, vec: np.ndarray, context: str):
+        """Return the cached entry with the same context most similar to vec, or None"""
+        if not self._cache_entries:
+            return None
+        sims = self._cache_vecs @ vec
+        # "and in Paris?" after one turn must not reuse "and in Berlin?" after another
+        same_context = np.array([e["context"] == context for e in self._cache_entries])
+        sims = np.where(same_context, sims, -np.inf)
+        idx = int(sims.argmax())
+        if sims[idx] < self.similarity_threshold:
+            return None
+        return self._cache_entries[idx]
+
+    def _cache_add(self, vec: np.ndarray, entry: dict, context: str):
+        """Remember an answered question, dropping the oldest past MAX_CACHE_ENTRIES"""
+        if self._cache_entries:
+            self._cache_vecs = np.vstack([self._cache_vecs, vec])
+        else:
+            self._cache_vecs = vec[np.newaxis, :]
+        cached = {key: entry[key] for key in ("question", "sql", "result", "answer")}
+        cached["context"] = context
+        self._cache_entries.append(cached)
+        self._cache_vecs = self._cache_vecs[-MAX_CACHE_ENTRIES:]
+        self._cache_entries = self._cache_entries[-MAX_CACHE_ENTRIES:]
+        # Rewriting the whole file per turn is slow; close() saves the rest
+        self._cache_unsaved += 1
+        if self._cache_unsaved >= CACHE_SAVE_EVERY:
+            self._save_embed_cache()
+
+    @staticmethod
+    def _format_scalar(raw: str):
+        """Readable text for one result value: 1,234 or 1,509.15; None for NULL or empty"""
+        if raw == "None":
+            return None
+        if raw[:1] in ("'", '"'):
+            return raw[1:-1] or None
+        try:
+            return f"{int(raw):,}"
+        except ValueError:
+            pass
+        try:
+            number = float(raw)
+        except ValueError:
+            return raw or None
+        if abs(number) < 1:
+            return f"{number:.4g}"
+        text = f"{number:,.2f}"
+        return text[:-3] if text.endswith(".00") else text
+
+    def _format_answer(self, template: str, result: str):
+        """Fill the answer template when the result is one value, None otherwise"""
+        scalar = self._SCALAR_RE.fullmatch(result)
+        if scalar is None or "{result}" not in template:
+            return None
+        value = self._format_scalar(scalar.group(1))
+        if value is None:
+            return None  # NULL aggregate, e.g. AVG over no rows, needs an explanation
+        try:
+            return template.format(result=value)
+        except (KeyError, IndexError, ValueError):
+            return None  # Template has other braces, let the LLM write the answer
+
+    def _recent(self, n: int):
+        """Iterate over the last n history entries, oldest first, without copying"""
+        return itertools.islice(
+            self.chat_history, max(0, len(self.chat_history) - n), None
+        )
+
+    def _relevant(self, vec, k: int) -> list:
+        """The latest history entry plus the k-1 earlier ones most similar to vec, oldest first"""
+        if vec is None or len(self.chat_history) <= k:
+            return list(self._recent(k))
 
-    def load_history(self) -> list:
-        """Load chat history from file"""
-        if Path(self.history_file).exists():
+        # Entries loaded from disk are embedded in one batch on first use
+        missing = [i for i, v in enumerate(self._history_vecs) if v is None]
+        if missing:
+            questions = [self.chat_history[i]["question"] for i in missing]
             try:
-                with open(self.history_file, "r") as f:
-                    return json.load(f)
-            except:
-                return []
-        return []
-
-    def save_history(self):
-        """Save chat history to file"""
-        with open(self.history_file, "w") as f:
-            json.dump(self.chat_history, f, indent=2)
-
-    def validate_sql(self, sql: str) -> tuple[bool, str]:
+                embedded = self._emb.embed_documents(questions)
+            except Exception:
+                return list(self._recent(k))
+            for i, v in zip(missing, embedded):
+                v = np.asarray(v, dtype=np.float32)
+                self._history_vecs[i] = v / np.linalg.norm(v)
+
+        # The latest turn always goes in, follow-ups like "in table format" need it
+        latest = len(self.chat_history) - 1
+        if k <= 1:
+            return [self.chat_history[latest]]
+        scores = np.stack(list(self._history_vecs)[:latest]) @ vec
+        top = np.sort(np.argpartition(scores, -(k - 1))[-(k - 1) :])
+        return [self.chat_history[i] for i in top] + [self.chat_history[latest]]
+
+    def _record(self, entry: dict, vec=None):
+        """Add a turn to the in-memory history and the history file"""
+        self.chat_history.append(entry)
+        self._history_vecs.append(vec)
+        self.save_history(entry)
+
+    def _connect_raw(self) -> sqlite3.Connection:
+        """One read-only connection reused by every query of the session"""
+        conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA query_only=ON")
+        # Let SQLite check the query deadline every 10K VM instructions
+        conn.set_progress_handler(self._deadline_check, 10_000)
+        return conn
+
+    def _deadline_check(self) -> int:
+        """SQLite progress handler, a non-zero return aborts the running query"""
+        deadline = self._query_deadline
+        return int(deadline is not None and time.monotonic() > deadline)
+
+    def parse_sql(self, sql: str) -> list:
+        """Parse SQL into sqlglot statements, empty if it can't be parsed"""
+        try:
+            statements = sqlglot.parse(sql, dialect="sqlite")
+        except sqlglot.errors.SqlglotError:
+            return []
+        return [statement for statement in statements if statement is not None]
+
+    def validate_sql(self, sql: str, statements: list = None) -> tuple[bool, str]:
         """
         Validate SQL query for safety and performance
         Returns: (is_valid, error_message)
         """
-        sql_upper = sql.upper()
-
-        # 1. Block dangerous operations
-        dangerous_keywords = [
-            "DROP",
-            "TRUNCATE",
-            "DELETE",
-            "ALTER",
-            "CREATE",
-            "GRANT",
-            "REVOKE",
-        ]
-        for keyword in dangerous_keywords:
-            if keyword in sql_upper:
-                return False, f"❌ '{keyword}' operations are not allowed for safety"
-
-        # 2. Check for SELECT * without LIMIT
-        if "SELECT *" in sql_upper or "SELECT\n*" in sql_upper:
-            if (
-                "LIMIT" not in sql_upper
-                and "COUNT(*)" not in sql_upper
-                and "COUNT (*)" not in sql_upper
-            ):
-                return (
-                    False,
-                    f"❌ SELECT * must include LIMIT {self.max_rows} to prevent loading too much data",
-                )
+        if statements is None:
+            statements = self.parse_sql(sql)
 
-        # 3. Check for LIMIT value
-        if "SELECT" in sql_upper and "LIMIT" not in sql_upper:
-            # Check if it's not an aggregation query
-            if not any(
-                agg in sql_upper for agg in ["COUNT(", "SUM(", "AVG(", "MAX(", "MIN("]
-            ):
+        # 1. Must be exactly one statement (SQL injection prevention)
+        if not statements:
+            return False, "❌ Could not parse the SQL query"
+        if len(statements) > 1:
+            return False, "❌ Multiple SQL statements are not allowed"
+        tree = statements[0]
+
+        # 2. Block dangerous operations: only read queries are allowed
+        blocked = (
+            tree if not isinstance(tree, exp.Query) else tree.find(*self._WRITE_NODES)
+        )
+        if blocked is not None:
+            keyword = blocked.sql(dialect="sqlite").split(None, 1)[0].upper()
+            return False, f"❌ '{keyword}' operations are not allowed for safety"
+
+        # 3. Check for SELECT (*) without LIMIT, unless it returns a single row
+        limit = tree.args.get("limit")
+        if limit is None and not self._is_single_row(tree):
+            if isinstance(tree, exp.Select) and tree.is_star:
                 return (
                     False,
-                    f"⚠️ Please add LIMIT {self.max_rows} to your SELECT query",
+                    f"❌ SELECT * must include LIMIT {self.max_rows} to prevent loading too much data",
                 )
+            return (
+                False,
+                f"⚠️ Please add LIMIT {self.max_rows} to your SELECT query",
+            )
 
         # 4. Validate LIMIT doesn't exceed max_rows
-        if "LIMIT" in sql_upper:
-            try:
-                # Extract limit value
-                limit_part = sql_upper.split("LIMIT")[1].strip().split()[0]
-                limit_value = int(limit_part.rstrip(";"))
+        # (if it isn't a plain number, let the database handle it)
+        if limit is not None:
+            value = limit.expression
+            if isinstance(value, exp.Literal) and value.is_int:
+                limit_value = int(value.to_py())
                 if limit_value > self.max_rows:
                     return (
                         False,
                         f"❌ LIMIT {limit_value} exceeds maximum allowed ({self.max_rows})",
                     )
-            except:
-                pass  # If parsing fails, let database handle it
-
-        # 5. Check for multiple statements (SQL injection prevention)
-        if sql.count(";") > 1:
-            return False, "❌ Multiple SQL statements are not allowed"
 
         return True, ""
 
     def clean_sql(self, sql: str) -> str:
         """Clean and format SQL query"""
-        sql = sql.strip()
-
-        # Remove markdown code blocks
-        if "```sql" in sql.lower():
-            sql = sql.split("```sql")[-1].split("```")[0]
-        elif "```" in sql:
-            sql = sql.split("```")[1].split("```")[0]
-
-        # Remove comments and explanations
-        lines = sql.strip().split("\n")
-        sql_lines = []
-        for line in lines:
-            line = line.strip()
-            # Skip empty lines and comment lines
-            if line and not line.startswith("--"):
-                sql_lines.append(line)
-
-        sql = " ".join(sql_lines)
-
-        # Find the actual SQL statement
-        sql_keywords = ["SELECT", "INSERT", "UPDATE", "DELETE", "WITH"]
-        for keyword in sql_keywords:
-            if keyword in sql.upper():
-                idx = sql.upper().index(keyword)
-                sql = sql[idx:]
-                break
+        # Keep only the body of the first markdown code block, if any
+        match = self._FENCE_RE.search(sql)
+        if match:
+            sql = match.group(1)
+
+        # Remove -- comments, then join the remaining lines
+        sql = self._COMMENT_RE.sub(
+            lambda m: "" if m.group().startswith("--") else m.group(), sql
+        )
+        sql = self._NEWLINES_RE.sub(" ", sql.strip())
+
+        # Drop any explanation before the actual SQL statement
+        match = self._KEYWORD_RE.search(sql)
+        if match:
+            sql = sql[match.start() :]
 
         # Ensure single semicolon at end
         sql = sql.strip().rstrip(";") + ";"
 
         return sql
 
-    def auto_add_limit(self, sql: str) -> str:
+    @staticmethod
+    def _is_single_row(tree) -> bool:
+        """Aggregate without GROUP BY, e.g. SELECT COUNT(*) FROM orders"""
+        return (
+            isinstance(tree, exp.Select)
+            and not tree.args.get("group")
+            and any(
+                # Aggregates in subqueries or window functions don't collapse the rows
+                agg.find_ancestor(exp.Select) is tree
+                and agg.find_ancestor(exp.Window) is None
+                for column in tree.expressions
+                for agg in column.find_all(exp.AggFunc)
+            )
+        )
+
+    def fetch_rows(self, sql: str) -> str:
+        """Run a query and format at most max_rows rows in max_result_chars"""
+        cursor = self._raw.execute(sql)
+        try:
+            rows = cursor.fetchmany(self.max_rows)
+        finally:
+            cursor.close()  # Finalize the statement, the rest is never read
+        if not rows:
+            return ""
+        result = str(rows)
+        if len(result) > self.max_result_chars:
+            print(f"⚠️ Large result: {len(result)} characters, truncated")
+            result = result[: self.max_result_chars] + " ...(truncated)"
+        return result
+
+    def auto_add_limit(self, sql: str, statements: list = None) -> str:
         """Automatically add LIMIT if missing and appropriate"""
-        sql_upper = sql.upper()
+        if statements is None:
+            statements = self.parse_sql(sql)
 
         # Don't add LIMIT if:
+        # - Not a single read query (validation rejects those)
         # - Already has LIMIT
-        # - Is an aggregation query
-        # - Is UPDATE/INSERT/DELETE
-        if "LIMIT" in sql_upper:
+        # - Is a single-row aggregation (GROUP BY queries still get one)
+        if len(statements) != 1:
             return sql
-
-        if any(agg in sql_upper for agg in ["COUNT(", "SUM(", "AVG(", "MAX(", "MIN("]):
+        tree = statements[0]
+        if not isinstance(tree, exp.Query):
             return sql
-
-        if any(
-            cmd in sql_upper for cmd in ["UPDATE", "INSERT", "DELETE", "CREATE", "DROP"]
-        ):
+        if tree.args.get("limit") is not None or self._is_single_row(tree):
             return sql
 
-        # Add LIMIT for SELECT queries
-        if "SELECT" in sql_upper:
-            sql = sql.rstrip(";") + f" LIMIT {self.max_rows};"
-
-        return sql
+        # Set it on the parsed tree too, so validation sees the same query
+        tree.set("limit", exp.Limit(expression=exp.Literal.number(self.max_rows)))
+        return tree.sql(dialect="sqlite") + ";"
 
     def run_sql(self, sql: str) -> str:
         """Execute SQL query safely with timeout and validation"""
@@ -206,41 +650,34 @@ Available Tables: {self.db.get_usable_table_names()}
         sql = self.clean_sql(sql)
         print(f"🧹 Cleaned SQL: {sql}")
 
-        # Step 2: Auto-add LIMIT
-        sql = self.auto_add_limit(sql)
-        if "LIMIT" in sql.upper():
+        # Step 2: Auto-add LIMIT (parsed once, shared with validation)
+        statements = self.parse_sql(sql)
+        limited_sql = self.auto_add_limit(sql, statements)
+        if limited_sql != sql:
+            sql = limited_sql
             print(f"➕ Auto-added LIMIT: {sql}")
 
         # Step 3: Validate SQL
-        is_valid, error_msg = self.validate_sql(sql)
+        is_valid, error_msg = self.validate_sql(sql, statements)
         if not is_valid:
             return error_msg
 
         # Step 4: Execute with timeout
         try:
-            # Set timeout alarm (Unix-based systems)
-            if hasattr(signal, "SIGALRM"):
-                signal.signal(signal.SIGALRM, timeout_handler)
-                signal.alarm(self.query_timeout)
-
+            # SQLite aborts the query from its progress handler past the deadline
             start_time = time.time()
-            result = self.db.run(sql)
+            self._query_deadline = time.monotonic() + self.query_timeout
+            try:
+                result = self.fetch_rows(sql)
+            except sqlite3.OperationalError:
+                if time.monotonic() > self._query_deadline:
+                    raise TimeoutException("Query execution timeout")
+                raise
             execution_time = time.time() - start_time
 
-            # Cancel alarm
-            if hasattr(signal, "SIGALRM"):
-                signal.alarm(0)
-
             # Log execution time
             print(f"⏱️ Query executed in {execution_time:.2f}s")
 
-            # Check result size
-            result_str = str(result)
-            if len(result_str) > 10000:
-                print(
-                    f"⚠️ Large result: {len(result_str)} characters ({len(result_str)//1000}KB)"
-                )
-
             return result
 
         except TimeoutException:
@@ -250,53 +687,87 @@ Available Tables: {self.db.get_usable_table_names()}
             return f"❌ SQL Error: {e}"
 
         finally:
-            # Always cancel alarm
-            if hasattr(signal, "SIGALRM"):
-                signal.alarm(0)
-
-    def build_context_messages(self) -> list:
-        """Build message list with history for context"""
-        messages = [SystemMessage(content=self.system_prompt)]
+            # Always clear the deadline
+            self._query_deadline = None
+
+    def build_context_messages(self, vec=None) -> list:
+        """Build message list with the history most relevant to vec, static parts first"""
+        messages = [
+            SystemMessage(content=self._STATIC_SYSTEM),
+            SystemMessage(content=self.schema_prompt),
+        ]
 
-        # Add last N conversations as context
-        for entry in self.chat_history[-5:]:
-            messages.append(HumanMessage(content=entry["question"]))
-            messages.append(AIMessage(content=entry["answer"]))
+        # Add the closest conversations as context (the latest without vec), oldest first
+        for entry in self._relevant(vec, CONTEXT_TURNS):
+            messages.extend(self._compact(entry))
 
         return messages
 
-    def ask(self, question: str) -> str:
-        # Build context from history
-        context_messages = self.build_context_messages()
+    def _compact(self, entry: dict) -> tuple:
+        """Question and answer messages for a past turn, with bulky results elided"""
+        placeholder = f"[result {entry.get('timestamp', '')[:19]}]"
+        answer = self._RESULT_RE.sub(placeholder, entry["answer"])
+        if len(answer) > CONTEXT_ANSWER_CHARS:
+            answer = answer[:CONTEXT_ANSWER_CHARS] + "..."
+        return (
+            HumanMessage(content=entry["question"]),
+            AIMessage(content=f"SQL: {entry['sql']}\n\n{answer}"),
+        )
+
+    def ask(self, question: str, on_token=None) -> str:
+        """Answer a question; pass ``on_token`` to receive answer tokens as they stream."""
+        # Embed once, for the answer cache and to pick relevant history
+        try:
+            vec = self._embed(question)
+        except Exception as e:
+            vec = None
+            print(f"⚠️ Embedding failed, using recent history only: {e}")
+
+        # Step 0: Reuse the answer of a near-identical earlier question
+        # Only follow-ups depend on the previous turn; standalone repeats match anywhere
+        context = self._context_hash() if self._FOLLOWUP_RE.search(question) else ""
+        if self._use_cache and vec is not None:
+            cached = self._cache_lookup(vec, context)
+            # Only trust the cached answer if its SQL still returns the same data
+            if cached is not None:
+                result = self.run_sql(cached["sql"])
+                if result == cached["result"]:
+                    print(f"\n♻️ Cached answer (SQL: {cached['sql']})")
+                    self._record(
+                        {
+                            "timestamp": datetime.now().isoformat(),
+                            "question": question,
+                            "sql": cached["sql"],
+                            "result": result,
+                            "answer": cached["answer"],
+                            "status": "success",
+                        },
+                        vec,
+                    )
+                    return cached["answer"]
 
-        # Recent history summary for SQL generation
-        recent_context = ""
-        if self.chat_history:
-            recent_context = "\n📚 Recent successful queries:\n"
-            for entry in self.chat_history[-3:]:
-                if not entry.get("result", "").startswith("❌"):
-                    recent_context += f"- Q: {entry['question']}\n"
-                    recent_context += f"  SQL: {entry['sql']}\n"
+        # Build context from the most relevant history
+        # Built once; each call swaps only the final prompt message
+        messages = self.build_context_messages(vec)
 
         # Step 1: Generate SQL
-        sql_prompt = f"""Write ONLY the SQL query for this question.
+        sql_prompt = f"""Write the SQL query for this question.
 
 IMPORTANT:
 - Add LIMIT {self.max_rows} for SELECT queries (unless using COUNT/SUM/AVG)
 - Use WHERE clauses to filter data
 - Prefer aggregations over full table scans
-- Return ONLY the SQL, no explanations
+- Put ONLY the SQL in `sql`, no explanations
+- In `answer_format`, write a short friendly answer with {{result}} where the value goes
 
-{recent_context}
+Question: {question}"""
 
-Question: {question}
-SQL:"""
-
-        sql_messages = context_messages + [HumanMessage(content=sql_prompt)]
+        messages.append(HumanMessage(content=sql_prompt))
 
         try:
-            sql_response = self.llm.invoke(sql_messages)
-            sql_query = sql_response.content.strip()
+            # One call returns both the SQL and an answer template
+            parsed = self.llm.with_structured_output(SqlAnswer).invoke(messages)
+            sql_query = parsed.sql.strip()
         except Exception as e:
             return f"❌ LLM Error: {e}"
 
@@ -307,23 +778,24 @@ SQL:"""
         print(f"📊 Result: {result[:500]}...")  # Truncate for display
 
         # Check if query failed
-        if str(result).startswith("❌"):
+        if result.startswith("❌"):
             # Save failed query to history
-            self.chat_history.append(
-                {
-                    "timestamp": datetime.now().isoformat(),
-                    "question": question,
-                    "sql": sql_query,
-                    "result": result,
-                    "answer": result,
-                    "status": "failed",
-                }
-            )
-            self.save_history()
+            entry = {
+                "timestamp": datetime.now().isoformat(),
+                "question": question,
+                "sql": sql_query,
+                "result": result,
+                "answer": result,
+                "status": "failed",
+            }
+            self._record(entry, vec)
             return result
 
-        # Step 3: Generate answer with context
-        answer_prompt = f"""Question: {question}
+        # Step 3: Fill the template for a single value, otherwise ask the LLM
+        answer = self._format_answer(parsed.answer_format, result)
+        answered = True
+        if answer is None:
+            answer_prompt = f"""Question: {question}
 SQL Query Used: {sql_query}
 Database Result: {result}
 
@@ -331,30 +803,36 @@ Provide a clear, friendly, and accurate answer based on the data.
 If the result is empty, explain that no matching records were found.
 Format numbers and data in a readable way:"""
 
-        answer_messages = context_messages + [HumanMessage(content=answer_prompt)]
+            messages[-1] = HumanMessage(content=answer_prompt)
 
-        try:
-            answer = self.llm.invoke(answer_messages).content
-        except Exception as e:
-            answer = f"Query succeeded but answer generation failed: {e}\n\nRaw result: {result}"
+            try:
+                if on_token is None:
+                    answer = self.llm.invoke(messages).content
+                else:
+                    # Stream so the first tokens show up before the full answer is done
+                    tokens = []
+                    for chunk in self.llm.stream(messages):
+                        # The role delta and the final chunk carry no text
+                        if chunk.content:
+                            tokens.append(chunk.content)
+                            on_token(chunk.content)
+                    answer = "".join(tokens)
+            except Exception as e:
+                answered = False
+                answer = f"Query succeeded but answer generation failed: {e}\n\nRaw result: {result}"
 
         # Step 4: Save to history
-        self.chat_history.append(
-            {
-                "timestamp": datetime.now().isoformat(),
-                "question": question,
-                "sql": sql_query,
-                "result": str(result)[:1000],  # Limit stored result size
-                "answer": answer,
-                "status": "success",
-            }
-        )
-
-        # Trim and save
-        if len(self.chat_history) > self.max_history:
-            self.chat_history = self.chat_history[-self.max_history :]
-
-        self.save_history()
+        entry = {
+            "timestamp": datetime.now().isoformat(),
+            "question": question,
+            "sql": sql_query,
+            "result": result,  # Already bounded by fetch_rows()
+            "answer": answer,
+            "status": "success",
+        }
+        self._record(entry, vec)
+        if answered and self._use_cache and vec is not None:
+            self._cache_add(vec, entry, context)
 
         return answer
 
@@ -380,8 +858,10 @@ Query Timeout:      {self.query_timeout}s
         return output
 
     def clear_history(self):
-        self.chat_history = []
-        self.save_history()
+        self.chat_history.clear()
+        self._history_vecs.clear()
+        self._rewrite_history()
+        self._history_index.execute("DELETE FROM history")
         return "✅ History cleared!"
 
     def show_history(self, limit: int = 5) -> str:
@@ -389,7 +869,7 @@ Query Timeout:      {self.query_timeout}s
             return "No history."
 
         output = "\n📜 Recent Conversations:\n" + "=" * 60 + "\n"
-        for i, entry in enumerate(self.chat_history[-limit:], 1):
+        for i, entry in enumerate(self._recent(limit), 1):
             status_icon = "✅" if entry.get("status") != "failed" else "❌"
             output += f"\n{status_icon} [{i}] {entry['timestamp'][:19]}\n"
             output += f"   Q: {entry['question']}\n"
@@ -399,31 +879,114 @@ Query Timeout:      {self.query_timeout}s
         return output
 
     def search_history(self, keyword: str) -> str:
-        """Search conversation history"""
-        matches = []
-        for entry in self.chat_history:
-            if (
-                keyword.lower() in entry["question"].lower()
-                or keyword.lower() in entry.get("answer", "").lower()
-                or keyword.lower() in entry.get("sql", "").lower()
-            ):
-                matches.append(entry)
-
-        if not matches:
+        """Search all past turns, best BM25 matches first"""
+        # Quote each word so user input can't break FTS5 syntax, * makes it a prefix
+        terms = ['"' + word.replace('"', '""') + '"*' for word in keyword.split()]
+        if not terms:
+            return "Usage: search <keyword>"
+        query = " ".join(terms)
+
+        total = self._history_index.execute(
+            "SELECT COUNT(*) FROM history_fts WHERE history_fts MATCH ?", (query,)
+        ).fetchone()[0]
+        if not total:
             return f"No matches found for '{keyword}'"
 
-        output = (
-            f"\n🔍 Found {len(matches)} matches for '{keyword}':\n" + "=" * 60 + "\n"
-        )
-        for entry in matches[-5:]:
-            status_icon = "✅" if entry.get("status") != "failed" else "❌"
-            output += f"\n{status_icon} Q: {entry['question']}\n"
-            output += f"   SQL: {entry['sql'][:80]}...\n"
-            output += f"   A: {entry.get('answer', 'N/A')[:100]}...\n"
+        matches = self._history_index.execute(
+            """SELECT h.question, h.sql, h.answer, h.status
+            FROM history_fts JOIN history h ON h.id = history_fts.rowid
+            WHERE history_fts MATCH ?
+            ORDER BY bm25(history_fts)
+            LIMIT 5""",
+            (query,),
+        ).fetchall()
+
+        output = f"\n🔍 Found {total} matches for '{keyword}':\n" + "=" * 60 + "\n"
+        for question, sql, answer, status in matches:
+            status_icon = "✅" if status != "failed" else "❌"
+            output += f"\n{status_icon} Q: {question}\n"
+            output += f"   SQL: {(sql or '')[:80]}...\n"
+            output += f"   A: {(answer or 'N/A')[:100]}...\n"
 
         return output
 
 
+def handle_quit(chat) -> bool:
+    print("👋 Goodbye!")
+    return True
+
+
+def handle_schema(chat):
+    print(f"\n{chat.get_schema()}\n")
+
+
+def handle_tables(chat):
+    print(f"\n📊 Tables: {chat.db.get_usable_table_names()}\n")
+
+
+def handle_history(chat, arg: str = "5"):
+    if arg.lower() == "all":
+        print(chat.show_history(len(chat.chat_history)))
+        return
+
+    try:
+        n = int(arg.split()[0])
+        print(chat.show_history(n))
+    except ValueError:
+        print("❌ Usage: history <number>")
+
+
+def handle_search(chat, keyword: str):
+    print(chat.search_history(keyword))
+
+
+def handle_stats(chat):
+    print(chat.get_stats())
+
+
+def handle_clear(chat):
+    confirm = input("⚠️ Clear all history? (yes/no): ").lower()
+    if confirm == "yes":
+        print(f"\n{chat.clear_history()}\n")
+    else:
+        print("❌ Cancelled\n")
+
+
+def handle_question(chat, question: str):
+    print("\n🔄 Processing...\n")
+    streamed = []
+
+    def on_token(token: str):
+        if not streamed:
+            sys.stdout.write("\n🤖 ")
+        streamed.append(token)
+        sys.stdout.write(token)
+        sys.stdout.flush()
+
+    answer = chat.ask(question, on_token=on_token)
+    if streamed and answer == "".join(streamed):
+        print("\n")
+    else:
+        print(f"\n🤖 {answer}\n")
+
+
+# REPL commands; a handler returning True ends the session
+COMMANDS = {
+    "quit": handle_quit,
+    "schema": handle_schema,
+    "tables": handle_tables,
+    "history": handle_history,
+    "stats": handle_stats,
+    "clear": handle_clear,
+}
+
+# Commands that take an argument after the command word
+ARG_COMMANDS = {
+    "history": handle_history,
+    "search": handle_search,
+}
+
+
 def main():
     # Initialize with production settings
     chat = SQLChatWithPersistence(
@@ -459,51 +1022,21 @@ def main():
             if not question:
                 continue
 
-            cmd = question.lower()
+            # Commands are looked up by their first word; anything else is a question
+            parts = question.split(maxsplit=1)
+            name = parts[0].lower()
+            if len(parts) == 1:
+                handler = COMMANDS.get(name)
+                args = ()
+            else:
+                handler = ARG_COMMANDS.get(name)
+                args = (parts[1].strip(),)
 
-            if cmd == "quit":
-                print("👋 Goodbye!")
+            if handler is None:
+                handle_question(chat, question)
+            elif handler(chat, *args):
                 break
 
-            elif cmd == "schema":
-                print(f"\n{chat.get_schema()}\n")
-
-            elif cmd == "tables":
-                print(f"\n📊 Tables: {chat.db.get_usable_table_names()}\n")
-
-            elif cmd == "history":
-                print(chat.show_history(5))
-
-            elif cmd == "history all":
-                print(chat.show_history(len(chat.chat_history)))
-
-            elif cmd.startswith("history "):
-                try:
-                    n = int(question.split()[1])
-                    print(chat.show_history(n))
-                except:
-                    print("❌ Usage: history <number>")
-
-            elif cmd.startswith("search "):
-                keyword = question[7:].strip()
-                print(chat.search_history(keyword))
-
-            elif cmd == "stats":
-                print(chat.get_stats())
-
-            elif cmd == "clear":
-                confirm = input("⚠️ Clear all history? (yes/no): ").lower()
-                if confirm == "yes":
-                    print(f"\n{chat.clear_history()}\n")
-                else:
-                    print("❌ Cancelled\n")
-
-            else:
-                # Ask question
-                print("\n🔄 Processing...\n")
-                answer = chat.ask(question)
-                print(f"\n🤖 {answer}\n")
-
         except KeyboardInterrupt:
             print("\n\n👋 Goodbye!")
             break
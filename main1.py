@@ -1,4 +1,6 @@
 import os
+import re
+import atexit
 import json
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
@@ -11,6 +13,23 @@ load_dotenv()
 
 
 class SQLChatWithPersistence:
+    # Fenced code block and the first DML statement, found in one pass each
+    _FENCE_RE = re.compile(r"```(?:sql)?\s*(.*?)```", re.S | re.I)
+    _DML_RE = re.compile(r"^\s*(?:SELECT|INSERT|UPDATE|DELETE)\b.*", re.I | re.M | re.S)
+
+    # Prompt templates, only the per-turn fields are filled in
+    _SQL_TMPL = """Write ONLY the SQL query for this question. No explanation.
+
+{ctx}
+
+Question: {q}
+SQL:"""
+    _ANSWER_TMPL = """Question: {q}
+SQL: {sql}
+Result: {result}
+
+Provide a clear, friendly answer:"""
+
     def __init__(self, max_history: int = 20, history_file: str = "chat_history.json"):
         self.llm = ChatOpenAI(
             openai_api_key=os.getenv("OPENROUTER_API_KEY"),
@@ -23,6 +42,9 @@ class SQLChatWithPersistence:
         self.max_history = max_history
         self.history_file = history_file
         self.chat_history = self.load_history()
+        # One handle for the session, rewritten in place on every save
+        self._hf = open(self.history_file, "a+")
+        atexit.register(self._hf.close)
 
         self.system_prompt = f"""You are a helpful SQL database assistant.
 Database Schema:
@@ -44,27 +66,20 @@ Database Schema:
 
     def save_history(self):
         """Save chat history to file"""
-        with open(self.history_file, "w") as f:
-            json.dump(self.chat_history, f, indent=2)
+        self._hf.seek(0)
+        self._hf.truncate()
+        json.dump(self.chat_history, self._hf, indent=2)
+        self._hf.flush()
 
     def run_sql(self, sql: str) -> str:
         """Execute SQL query safely"""
-        sql = sql.strip()
-
-        if "```sql" in sql.lower():
-            sql = sql.split("```sql")[-1].split("```")[0]
-        elif "```" in sql:
-            sql = sql.split("```")[1].split("```")[0]
+        fence = self._FENCE_RE.search(sql)
+        if fence:
+            sql = fence.group(1)
 
-        lines = sql.strip().split("\n")
-        for i, line in enumerate(lines):
-            if (
-                line.strip()
-                .upper()
-                .startswith(("SELECT", "INSERT", "UPDATE", "DELETE"))
-            ):
-                sql = "\n".join(lines[i:])
-                break
+        dml = self._DML_RE.search(sql)
+        if dml:
+            sql = dml.group(0)
 
         sql = sql.strip().rstrip(";") + ";"
 
@@ -84,25 +99,23 @@ Database Schema:
 
         return messages
 
+    def recent_context(self) -> str:
+        """Recent history summary for SQL generation"""
+        if not self.chat_history:
+            return ""
+        return "Recent queries:\n" + "".join(
+            f"- Q: {entry['question']}\n  SQL: {entry['sql']}\n"
+            for entry in self.chat_history[-3:]
+        )
+
     def ask(self, question: str) -> str:
         # Build context from history
         context_messages = self.build_context_messages()
 
-        # Recent history summary for SQL generation
-        recent_context = ""
-        if self.chat_history:
-            recent_context = "Recent queries:\n"
-            for entry in self.chat_history[-3:]:
-                recent_context += f"- Q: {entry['question']}\n"
-                recent_context += f"  SQL: {entry['sql']}\n"
-
         # Step 1: Generate SQL
-        sql_prompt = f"""Write ONLY the SQL query for this question. No explanation.
-
-{recent_context}
-
-Question: {question}
-SQL:"""
+        sql_prompt = self._SQL_TMPL.format_map(
+            {"ctx": self.recent_context(), "q": question}
+        )
 
         sql_messages = context_messages + [HumanMessage(content=sql_prompt)]
         sql_response = self.llm.invoke(sql_messages)
@@ -115,11 +128,9 @@ SQL:"""
         print(f"📊 Result: {result}")
 
         # Step 3: Generate answer with context
-        answer_prompt = f"""Question: {question}
-SQL: {sql_query}
-Result: {result}
-
-Provide a clear, friendly answer:"""
+        answer_prompt = self._ANSWER_TMPL.format_map(
+            {"q": question, "sql": sql_query, "result": result}
+        )
 
         answer_messages = context_messages + [HumanMessage(content=answer_prompt)]
         answer = self.llm.invoke(answer_messages).content
@@ -182,6 +193,16 @@ Provide a clear, friendly answer:"""
         return output
 
 
+# REPL commands matched on the whole input; each returns the text to print
+COMMANDS = {
+    "schema": lambda chat: f"\n{chat.get_schema()}\n",
+    "tables": lambda chat: f"\nTables: {chat.db.get_usable_table_names()}\n",
+    "history": lambda chat: chat.show_history(5),
+    "history all": lambda chat: chat.show_history(len(chat.chat_history)),
+    "clear": lambda chat: f"\n{chat.clear_history()}\n",
+}
+
+
 def main():
     chat = SQLChatWithPersistence(max_history=20)
 
@@ -207,23 +228,16 @@ def main():
             continue
 
         cmd = question.lower()
+        handler = COMMANDS.get(cmd)
 
         if cmd == "quit":
             print("Goodbye!")
             break
-        elif cmd == "schema":
-            print(f"\n{chat.get_schema()}\n")
-        elif cmd == "tables":
-            print(f"\nTables: {chat.db.get_usable_table_names()}\n")
-        elif cmd == "history":
-            print(chat.show_history(5))
-        elif cmd == "history all":
-            print(chat.show_history(len(chat.chat_history)))
+        elif handler is not None:
+            print(handler(chat))
         elif cmd.startswith("search "):
             keyword = question[7:].strip()
             print(chat.search_history(keyword))
-        elif cmd == "clear":
-            print(f"\n{chat.clear_history()}\n")
         else:
             try:
                 answer = chat.ask(question)